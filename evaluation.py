@@ -5,29 +5,22 @@ from mindmerger_tools.utils import extract_last_num
 import math
 import torch
 
-def evaluate_math(model, test_set, tokenizer_llm, tokenizer_mt, max_seq_len,
-                  max_gen_len, use_prompt, langs_map):
+@torch.inference_mode()
+def evaluate_math(model, test_set, tokenizer_llm):
     model.eval()
     results_list = []
+    hits = []
     hit = 0
     step_trange = tqdm(test_set)
     preds, golds = [], []
     for test_step in step_trange:
+        test_step = features_to_cuda(test_step)
         sources = test_step['source']
         prompts = test_step['prompt']
         targets = test_step['target']
-        source_languages = test_step['source_language']
-        input_ids_m2m, attention_mask_m2m = mt_input_features(sources, tokenizer_mt,
-                                                              max_seq_len, source_languages, langs_map)
-        input_ids_prompt, mask_prompt = None, None
-        if use_prompt:
-            add_bos_token = False
-            add_eos_token = False
-            input_ids_prompt, mask_prompt = llm_input_features(prompts, tokenizer_llm, max_gen_len, add_bos_token,
-                                                           add_eos_token)
-        generate_ids = model(input_ids_m2m, attention_mask_m2m,
-                             input_ids_prompt=input_ids_prompt,
-                             mask_prompt=mask_prompt)
+        generate_ids = model(test_step['input_ids_mt'], test_step['attention_mask_mt'],
+                             input_ids_prompt=test_step['input_ids_prompt'],
+                             mask_prompt=test_step['mask_prompt'])
 
         results = tokenizer_llm.batch_decode(generate_ids,
                                                skip_special_tokens=True,
@@ -45,37 +38,30 @@ def evaluate_math(model, test_set, tokenizer_llm, tokenizer_mt, max_seq_len,
                 'prediction': str(result_p),
                 'output': result
             })
-            if float(answer) == float(result_p):
-                hit += 1
+            hits.append(float(answer) == float(result_p))
+            hit += hits[-1]
         acc = round(hit / len(results_list) * 100, 2)
         loss_show = 'Acc:' + str(acc)
         step_trange.set_postfix_str(loss_show)
 
     acc = round(hit / len(results_list) * 100, 2)
-    return acc, results_list
+    return acc, results_list, hits
 
-def evaluate_classification(model, test_set, tokenizer_llm, tokenizer_mt, max_seq_len,
-                  max_gen_len, use_prompt, langs_map):
+@torch.inference_mode()
+def evaluate_classification(model, test_set, tokenizer_llm):
     model.eval()
     results_list = []
+    hits = []
     hit = 0
     step_trange = tqdm(test_set)
     preds, golds = [], []
     for test_step in step_trange:
+        test_step = features_to_cuda(test_step)
         prompts = test_step['prompt']
         targets = test_step['target']
-        source_languages = test_step['source_language']
-        input_ids_m2m, attention_mask_m2m = mt_input_features(prompts, tokenizer_mt,
-                                                              max_seq_len, source_languages, langs_map)
-        input_ids_prompt, mask_prompt = None, None
-        if use_prompt:
-            add_bos_token = False
-            add_eos_token = False
-            input_ids_prompt, mask_prompt = llm_input_features(prompts, tokenizer_llm, max_gen_len, add_bos_token,
-                                                           add_eos_token)
-        generate_ids = model(input_ids_m2m, attention_mask_m2m,
-                             input_ids_prompt=input_ids_prompt,
-                             mask_prompt=mask_prompt)
+        generate_ids = model(test_step['input_ids_mt'], test_step['attention_mask_mt'],
+                             input_ids_prompt=test_step['input_ids_prompt'],
+                             mask_prompt=test_step['mask_prompt'])
 
         results = tokenizer_llm.batch_decode(generate_ids,
                                                skip_special_tokens=True,
@@ -91,48 +77,39 @@ def evaluate_classification(model, test_set, tokenizer_llm, tokenizer_mt, max_se
                 'prediction': result,
                 'answer': target
             })
-            if target == result:
-                hit += 1
+            hits.append(target == result)
+            hit += hits[-1]
 
         acc = round(hit / len(results_list) * 100, 2)
         loss_show = 'Acc:' + str(acc)
         step_trange.set_postfix_str(loss_show)
 
     acc = round(hit / len(results_list) * 100, 2)
-    return acc, results_list
+    return acc, results_list, hits
 
 
-def evaluate_ppl(model, test_set, tokenizer_llm, tokenizer_mt, max_seq_len, max_gen_len, langs_map, use_prompt):
+@torch.inference_mode()
+def evaluate_ppl(model, test_set, cutoff=None):
     model.eval()
     step_trange = tqdm(test_set)
     loss_all = 0
     step_i = 0
     for test_step in step_trange:
         step_i += 1
-        sources = test_step['source']
-        prompts = test_step['prompt']
-        targets = test_step['target']
-        source_languages = test_step['source_language']
-        input_ids_m2m, attention_mask_m2m = mt_input_features(sources, tokenizer_mt,
-                                                              max_seq_len, source_languages, langs_map)
-        add_bos_token = False
-        add_eos_token = True
-        labels, mask_label = llm_input_features(targets, tokenizer_llm,
-                                                  max_gen_len, add_bos_token, add_eos_token)
-
-        input_ids_prompt, mask_prompt = None, None
-        if use_prompt:
-            add_bos_token = False
-            add_eos_token = False
-            input_ids_prompt, mask_prompt = llm_input_features(prompts, tokenizer_llm,
-                                                                 max_gen_len, add_bos_token,
-                                                                 add_eos_token)
-        loss = model(input_ids_m2m, attention_mask_m2m,
-                     input_ids_prompt=input_ids_prompt, mask_prompt=mask_prompt,
-                     labels=labels, mask_label=mask_label)
-        loss_all += loss.mean().item()
+        test_step = features_to_cuda(test_step)
+        loss = model(test_step['input_ids_mt'], test_step['attention_mask_mt'],
+                     input_ids_prompt=test_step['input_ids_prompt'], mask_prompt=test_step['mask_prompt'],
+                     labels=test_step['labels'], mask_label=test_step['mask_label'])
+        loss_all += loss.item()
         loss_show = 'loss:' + str(round(loss_all / (step_i), 4))
         step_trange.set_postfix_str(loss_show)
+        # once half of the dev set is clearly worse than cutoff, the rest is unlikely to make up for it
+        if cutoff is not None and step_i * 2 >= len(test_set) and math.exp(loss_all / step_i) > cutoff * 1.02:
+            print('partial ppl:', math.exp(loss_all / step_i), 'stopped after', step_i, 'of', len(test_set), 'batches')
+            model.train()
+            torch.cuda.empty_cache()
+            # a partial value is not comparable to a full one, never count it as an improvement
+            return math.inf
 
     loss = loss_all / step_i
     perplexity = math.exp(loss)
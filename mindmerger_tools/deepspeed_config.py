@@ -9,7 +9,8 @@ def get_train_ds_config(train_batch_size=1,
                         release_inference_cache=False,
                         pin_parameters=True,
                         tp_gather_partition_size=8,
-                        max_out_tokens=512):
+                        max_out_tokens=512,
+                        bf16_enabled=True):
 
     device = "cpu" if offload else "none"
     zero_opt_dict = {
@@ -31,7 +32,7 @@ def get_train_ds_config(train_batch_size=1,
         "steps_per_print": 2000,
         "zero_optimization": zero_opt_dict,
         "bf16": {
-            "enabled": True,
+            "enabled": bf16_enabled,
             "loss_scale_window": 50,
             "min_loss_scale": 1e-10,
         },
@@ -1,26 +1,44 @@
 
 import torch
+# the M2M/mT5 codes are the ISO codes the dataset readers already use for file names
+from .read_datasets import langs_map as langs_map_m2m
 
-def mt_input_features(input_texts_m2m, tokenizer_m2m, max_seq_len, source_languages, langs_map):
-    input_ids_m2m, attention_mask_m2m = [], []
-    for input_text_m2m, source_language in zip(input_texts_m2m, source_languages):
-        tokenizer_m2m.src_lang = langs_map[source_language]
-        encoding_m2m = tokenizer_m2m(input_text_m2m,
-                                     padding='longest',
+langs_map_nllb = {
+    'English': 'eng_Latn', 'Swahili': 'swh_Latn', 'Chinese': 'zho_Hans', 'Bengali': 'ben_Beng',
+    'German': 'deu_Latn', 'Spanish': 'spa_Latn', 'French': 'fra_Latn', 'Japanese': 'jpn_Jpan',
+    'Russian': 'rus_Cyrl', 'Thai': 'tha_Thai'
+}
+
+def get_langs_map(mt_path):
+    # language codes used for tokenizer_m2m.src_lang
+    if 'nllb' in mt_path:
+        return langs_map_nllb
+    return langs_map_m2m
+
+def features_to_cuda(features):
+    # the DataLoaders pin their batches, so these copies are asynchronous
+    return {key: value.cuda(non_blocking=True) if isinstance(value, torch.Tensor) else value
+            for key, value in features.items()}
+
+def mt_input_features(input_texts_m2m, tokenizer_m2m, max_seq_len, source_languages, langs_map,
+                      pad_to_multiple_of=None):
+    # one tokenizer call per language in the batch; setting src_lang re-resolves the
+    # language code token on NLLB/M2M tokenizers
+    languages = {}
+    for i, source_language in enumerate(source_languages):
+        languages.setdefault(source_language, []).append(i)
+    input_ids_m2m = [None] * len(input_texts_m2m)
+    for source_language, indices in languages.items():
+        src_lang = langs_map[source_language]
+        if getattr(tokenizer_m2m, 'src_lang', None) != src_lang:
+            tokenizer_m2m.src_lang = src_lang
+        encoding_m2m = tokenizer_m2m([input_texts_m2m[i] for i in indices],
                                      max_length=max_seq_len,
                                      truncation=True)
-        input_ids_m2m_item = encoding_m2m.input_ids
-        attention_mask_m2m_item = encoding_m2m.attention_mask
-        input_ids_m2m.append(input_ids_m2m_item)
-        attention_mask_m2m.append(attention_mask_m2m_item)
-    max_len = max([len(item) for item in input_ids_m2m])
-    m2m_pad_id = tokenizer_m2m.pad_token_id
-    for input_ids_m2m_item, attention_mask_m2m_item in zip(input_ids_m2m, attention_mask_m2m):
-        while len(input_ids_m2m_item) < max_len:
-            input_ids_m2m_item.append(m2m_pad_id)
-            attention_mask_m2m_item.append(0)
-    input_ids_m2m = torch.tensor(input_ids_m2m, dtype=torch.long).cuda()
-    attention_mask_m2m = torch.tensor(attention_mask_m2m, dtype=torch.long).cuda()
+        for i, input_ids_m2m_item in zip(indices, encoding_m2m.input_ids):
+            input_ids_m2m[i] = input_ids_m2m_item
+    input_ids_m2m, attention_mask_m2m = pad_input_ids(input_ids_m2m, tokenizer_m2m.pad_token_id, 'right',
+                                                      pad_to_multiple_of)
     return input_ids_m2m, attention_mask_m2m
 
 def bert_t5_input_features(input_texts_m2m, tokenizer_m2m, max_seq_len):
@@ -43,6 +61,92 @@ def llm_input_features(input_texts_llm, tokenizer_llm,
                          max_length=max_seq_len,
                          truncation=True,
                          return_tensors="pt")
-    input_ids_llm = encoding_llm.input_ids.cuda()
-    attention_mask_llm = encoding_llm.attention_mask.cuda()
+    input_ids_llm = encoding_llm.input_ids
+    attention_mask_llm = encoding_llm.attention_mask
     return input_ids_llm, attention_mask_llm
+
+def collate_features(batch, tokenizer_m2m, tokenizer_llm, max_seq_len, max_gen_len, langs_map,
+                     use_prompt, pad_to_multiple_of=None):
+    # used as DataLoader collate_fn, so tokenization runs in the workers and overlaps with the GPU;
+    # tensors stay on the CPU and are moved with features_to_cuda in the main process
+    features = {key: [sample[key] for sample in batch]
+                for key in ['source', 'prompt', 'target', 'source_language']}
+    features['input_ids_mt'], features['attention_mask_mt'] = mt_input_features(features['source'], tokenizer_m2m,
+                                                                                max_seq_len,
+                                                                                features['source_language'],
+                                                                                langs_map,
+                                                                                pad_to_multiple_of=pad_to_multiple_of)
+    features['input_ids_prompt'], features['mask_prompt'] = None, None
+    if use_prompt:
+        add_bos_token = False
+        add_eos_token = False
+        features['input_ids_prompt'], features['mask_prompt'] = llm_input_features(features['prompt'], tokenizer_llm,
+                                                                                   max_gen_len, add_bos_token,
+                                                                                   add_eos_token)
+    return features
+
+def pretokenize_features(dataset, tokenizer_m2m, tokenizer_llm, max_seq_len, max_gen_len, langs_map,
+                         use_prompt):
+    # tokenize the whole dataset once so that every epoch only pads; samples are grouped by
+    # language, so src_lang is set once per language and each group is a single tokenizer call.
+    # ids are kept as int32 tensors, python lists of ints are several times larger and get
+    # copied into every forked DataLoader worker as their refcounts change
+    features = []
+    for i in range(len(dataset)):
+        sample = dataset[i]
+        features.append({key: sample[key] for key in ['source', 'prompt', 'target', 'source_language']})
+    languages = {}
+    for i, feature in enumerate(features):
+        languages.setdefault(feature['source_language'], []).append(i)
+    for source_language, indices in languages.items():
+        tokenizer_m2m.src_lang = langs_map[source_language]
+        input_ids_mt = tokenizer_m2m([features[i]['source'] for i in indices],
+                                     max_length=max_seq_len,
+                                     truncation=True).input_ids
+        for i, input_ids_mt_item in zip(indices, input_ids_mt):
+            features[i]['input_ids_mt'] = torch.tensor(input_ids_mt_item, dtype=torch.int32)
+    if use_prompt:
+        tokenizer_llm.add_bos_token = False
+        tokenizer_llm.add_eos_token = False
+        input_ids_prompt = tokenizer_llm([feature['prompt'] for feature in features],
+                                         max_length=max_gen_len,
+                                         truncation=True).input_ids
+        for feature, input_ids_prompt_item in zip(features, input_ids_prompt):
+            feature['input_ids_prompt'] = torch.tensor(input_ids_prompt_item, dtype=torch.int32)
+    tokenizer_llm.add_bos_token = False
+    tokenizer_llm.add_eos_token = True
+    labels = tokenizer_llm([feature['target'] for feature in features],
+                           max_length=max_gen_len,
+                           truncation=True).input_ids
+    for feature, labels_item in zip(features, labels):
+        feature['labels'] = torch.tensor(labels_item, dtype=torch.int32)
+    return features
+
+def pad_input_ids(sequences, pad_token_id, padding_side, pad_to_multiple_of=None):
+    max_len = max([len(sequence) for sequence in sequences])
+    if pad_to_multiple_of is not None:
+        # bucketed lengths let compiled graphs be reused across batches
+        max_len += -max_len % pad_to_multiple_of
+    input_ids = torch.full([len(sequences), max_len], pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros([len(sequences), max_len], dtype=torch.long)
+    for i, sequence in enumerate(sequences):
+        start = max_len - len(sequence) if padding_side == 'left' else 0
+        input_ids[i, start:start + len(sequence)] = torch.as_tensor(sequence)
+        attention_mask[i, start:start + len(sequence)] = 1
+    return input_ids, attention_mask
+
+def collate_pretokenized(batch, mt_pad_token_id, llm_pad_token_id, pad_to_multiple_of=None):
+    # same output as collate_features for samples from pretokenize_features; MT inputs are
+    # padded on the right and LLM inputs on the left, as the tokenizers do
+    features = {key: [sample[key] for sample in batch]
+                for key in ['source', 'prompt', 'target', 'source_language']}
+    features['input_ids_mt'], features['attention_mask_mt'] = pad_input_ids([sample['input_ids_mt'] for sample in batch],
+                                                                            mt_pad_token_id, 'right',
+                                                                            pad_to_multiple_of)
+    features['input_ids_prompt'], features['mask_prompt'] = None, None
+    if 'input_ids_prompt' in batch[0]:
+        features['input_ids_prompt'], features['mask_prompt'] = pad_input_ids([sample['input_ids_prompt'] for sample in batch],
+                                                                              llm_pad_token_id, 'left')
+    features['labels'], features['mask_label'] = pad_input_ids([sample['labels'] for sample in batch],
+                                                               llm_pad_token_id, 'left')
+    return features
@@ -1,5 +1,7 @@
 import json
+from itertools import islice
 from torch.utils.data import Dataset
+from torch.utils.data.distributed import DistributedSampler
 from .prompts import *
 import random
 
@@ -32,6 +34,30 @@ class MathDataset(Dataset):
             sample['prompt'] = construct_prompt_math(sample['source'])
         return sample
 
+class LengthGroupedDistributedSampler(DistributedSampler):
+    # shards and shuffles like DistributedSampler, then sorts each megabatch of
+    # megabatch_size * batch_size samples by length so that micro batches need little padding
+    def __init__(self, dataset, lengths, batch_size, megabatch_size=50, **kwargs):
+        super().__init__(dataset, **kwargs)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.megabatch_size = megabatch_size
+    def __iter__(self):
+        indices = list(super().__iter__())
+        megabatch_len = self.megabatch_size * self.batch_size
+        batches = []
+        for i in range(0, len(indices), megabatch_len):
+            megabatch = sorted(indices[i:i + megabatch_len], key=lambda idx: self.lengths[idx], reverse=True)
+            batches += [megabatch[j:j + self.batch_size] for j in range(0, len(megabatch), self.batch_size)]
+        # shuffle the batches so that long batches are spread over the epoch; a short last batch
+        # stays last to keep the DataLoader batch boundaries aligned
+        last = batches.pop() if batches and len(batches[-1]) < self.batch_size else None
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        if last is not None:
+            batches.append(last)
+        return iter([idx for batch in batches for idx in batch])
+
 
 def read_lego(train_num, languages):
     # languages = ['Swahili', 'Urdu', 'Hindi', 'Thai', 'Arabic', 'Turkish', 'Greek', 'Vietnamese',
@@ -43,8 +69,8 @@ def read_lego(train_num, languages):
         path_base = f'./datas/bilingual_pairs/en-{train_name_map}'
         path_src = f'{path_base}/train_100k.{train_name_map}'
         path_trg = f'{path_base}/train_100k.en'
-        sources = read_dataset(path_src)[:train_num]
-        targets = read_dataset(path_trg)[:train_num]
+        sources = read_dataset(path_src, train_num)
+        targets = read_dataset(path_trg, train_num)
         train_set = [(source, target) for source, target in zip(sources, targets)]
         for source, target in train_set:
             dataset_train.append({
@@ -137,12 +163,12 @@ def read_docs(path):
     return lines
 
 
-def read_dataset(path):
+def read_dataset(path, max_num=None):
+    # line based files are only read up to max_num lines instead of loading them whole
     if 'jsonl' in path:
         dataset = []
         with open(path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            for line in lines:
+            for line in islice(f, max_num):
                 dataset.append(json.loads(line))
     elif 'json' in path:
         with open(path, 'r', encoding='utf-8') as f:
@@ -150,9 +176,11 @@ def read_dataset(path):
         if isinstance(dataset, dict):
             if 'data' in dataset:
                 dataset = dataset['data']
+        if max_num is not None:
+            dataset = dataset[:max_num]
     else:
         with open(path, 'r', encoding='utf-8') as f:
-            dataset = f.readlines()
+            dataset = list(islice(f, max_num))
     return dataset
 
 
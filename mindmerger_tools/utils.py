@@ -26,10 +26,8 @@ def save_dataset(path, name, dataset):
     os.makedirs(path, exist_ok=True)
     path = path + '/' + name
     if path.endswith('txt'):
-        with open(path, 'w', encoding='utf-8') as f:
-            for line in dataset:
-                line = line.strip()
-                f.write(line + '\n')
+        with open(path, 'w', encoding='utf-8', buffering=1024 * 1024) as f:
+            f.writelines(line.strip() + '\n' for line in dataset)
     else:
         with open(path, 'w', encoding='utf-8') as f:
             json.dump(dataset, f, ensure_ascii=False, indent=2)
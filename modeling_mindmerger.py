@@ -1,8 +1,21 @@
 
-from transformers import AutoModelForCausalLM, AutoModel
+from transformers import AutoConfig, AutoModelForCausalLM, AutoModel, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
+from collections import OrderedDict
 import torch
+import os
 from torch import nn
 
+def from_pretrained_fused_attention(auto_class, path, **kwargs):
+    # prefer FlashAttention-2 when it is installed, then SDPA; architectures that support
+    # neither (e.g. mT5) keep their default attention
+    model_class = auto_class._model_mapping[type(AutoConfig.from_pretrained(path))]
+    if is_flash_attn_2_available() and model_class._supports_flash_attn_2:
+        kwargs['attn_implementation'] = 'flash_attention_2'
+    elif model_class._supports_sdpa:
+        kwargs['attn_implementation'] = 'sdpa'
+    return auto_class.from_pretrained(path, **kwargs)
+
 class MLP(nn.Module):
     def __init__(self, mt_dim, llm_dim):
         super(MLP, self).__init__()
@@ -10,10 +23,7 @@ class MLP(nn.Module):
         self.linear2 = nn.Linear(mt_dim * 2, llm_dim)
         self.relu = nn.ReLU()
     def forward(self, mt_hidden_state):
-        output = self.linear1(mt_hidden_state)
-        output = self.relu(output)
-        output = self.linear2(output)
-        return output
+        return self.linear2(self.relu(self.linear1(mt_hidden_state)))
 
 class Mapping(nn.Module):
     def __init__(self, mt_dim, llm_dim):
@@ -31,25 +41,38 @@ class Mapping(nn.Module):
 
 class MindMerger(nn.Module):
     def __init__(self, mt_path, llm_path, max_gen_len, llm_bos_token_id,
-                 llm_pad_token_id):
+                 llm_pad_token_id, use_compile=False, encoder_cache_mb=0,
+                 llm_quantization=None):
         super(MindMerger, self).__init__()
         self.max_gen_len = max_gen_len
 
-        model_mt = AutoModel.from_pretrained(mt_path)
+        model_mt = from_pretrained_fused_attention(AutoModel, mt_path, torch_dtype=torch.bfloat16)
         print('MT model size:', sum(param.numel() for param in model_mt.parameters()) / 1000000)
         self.model_mt = model_mt
-        for name, parameter in self.model_mt.named_parameters():
-            parameter.requires_grad = False
+        self.model_mt.requires_grad_(False)
         if 'bert' in mt_path or 'GPT' in mt_path:
             self.encoder_mt = self.model_mt
         else:
             self.encoder_mt = self.model_mt.get_encoder()
         print('used size:', sum(param.numel() for param in self.encoder_mt.parameters()) / 1000000)
-        model_llm = AutoModelForCausalLM.from_pretrained(llm_path)
+        llm_kwargs = {}
+        if llm_quantization == '4bit':
+            # the LLM is frozen, so NF4 weights only cost dequantization in the forward pass
+            llm_kwargs['quantization_config'] = BitsAndBytesConfig(load_in_4bit=True,
+                                                                   bnb_4bit_quant_type='nf4',
+                                                                   bnb_4bit_compute_dtype=torch.bfloat16,
+                                                                   bnb_4bit_use_double_quant=True)
+        elif llm_quantization == '8bit':
+            llm_kwargs['quantization_config'] = BitsAndBytesConfig(load_in_8bit=True)
+        elif llm_quantization is not None:
+            raise ValueError(f"unknown llm_quantization {llm_quantization!r}, expected '4bit' or '8bit'")
+        if llm_quantization is not None:
+            # bitsandbytes weights are placed at load time and cannot be moved afterwards
+            llm_kwargs['device_map'] = {'': int(os.environ.get('LOCAL_RANK', 0))}
+        model_llm = from_pretrained_fused_attention(AutoModelForCausalLM, llm_path, torch_dtype=torch.bfloat16, **llm_kwargs)
         self.model_llm = model_llm
         self.llm_embedding_layer = self.model_llm.get_input_embeddings()
-        for name, parameter in self.model_llm.named_parameters():
-            parameter.requires_grad = False
+        self.model_llm.requires_grad_(False)
         if 'bert' in mt_path:
             d_model = model_mt.config.hidden_size
         elif 'GPT' in mt_path:
@@ -59,32 +82,68 @@ class MindMerger(nn.Module):
         self.mapping = Mapping(d_model, model_llm.config.hidden_size)
         self.llm_pad_token_id = llm_pad_token_id
         self.llm_bos_token_id = llm_bos_token_id
+        # the LLM embeddings are frozen, so the BOS embedding can be looked up once
+        with torch.no_grad():
+            bos = torch.tensor([llm_bos_token_id], dtype=torch.long, device=self.llm_embedding_layer.weight.device)
+            bos_embedding = self.llm_embedding_layer(bos).view(1, 1, -1)
+        self.register_buffer('bos_embedding', bos_embedding, persistent=False)
+        self.register_buffer('ones_mask', torch.ones([1, 1], dtype=torch.long), persistent=False)
         print('mapping layer size:', sum(param.numel() for param in self.mapping.parameters()) / 1000000)
-
-    def squeeze_pad(self, hidden_states, masks):
-        x_01 = (masks != 0).long()
-
-        seq_num_len = x_01.size(1)
-        offset = torch.tensor([(i + 1) for i in range(seq_num_len)], dtype=torch.long).to(x_01.device)
-        offset = offset.unsqueeze(dim=0).expand_as(x_01)
-        x_01 *= offset
-        _, idx = x_01.sort(1, descending=False)
-
-        masks = masks.gather(1, idx)
-        idx = idx.unsqueeze(dim=-1).expand_as(hidden_states)
-        hidden_states = hidden_states.gather(1, idx)
-
+        if use_compile:
+            # compiled in place so that state_dict keys (and saved mapping checkpoints) are unchanged
+            self.encoder_mt.compile(mode='reduce-overhead', dynamic=True)
+            self.mapping.compile()
+            self.model_llm.compile(dynamic=True)
+        # the MT model is frozen, so its outputs can be reused across repeated evaluations of the same batches
+        self.encoder_cache_bytes = encoder_cache_mb * 1024 * 1024
+        self.encoder_cache_used = 0
+        self.encoder_cache = OrderedDict()
+
+    def squeeze_pad(self, hidden_states, masks, labels=None):
+        # move the non-pad positions of every row to the right, keeping their order, and
+        # drop the columns that are padding in all rows; pad positions go to a dump column
+        keep = masks != 0
         bs, seq_len, dim = hidden_states.size()
-        masks_sum = torch.sum(masks, dim=0)
-        idx = masks_sum > 0
-        idx = idx.unsqueeze(dim=0).expand_as(masks)
-        masks = masks[idx]
-        idx_ex = idx.unsqueeze(dim=-1).expand_as(hidden_states)
-        hidden_states = hidden_states[idx_ex]
-        hidden_states = hidden_states.view(bs, -1, dim)
-        masks = masks.view(bs, -1)
+        keep_num = keep.sum(dim=1, keepdim=True)
+        new_len = int(keep_num.max())
+        idx = keep.long().cumsum(dim=1) - 1 + (new_len - keep_num)
+        idx = idx.masked_fill(~keep, new_len)
 
-        return hidden_states, masks, idx
+        masks = masks.new_zeros([bs, new_len + 1]).scatter(1, idx, masks)
+        idx_ex = idx.unsqueeze(dim=-1).expand_as(hidden_states)
+        hidden_states = hidden_states.new_zeros([bs, new_len + 1, dim]).scatter(1, idx_ex, hidden_states)
+        hidden_states = hidden_states[:, :new_len]
+        masks = masks[:, :new_len]
+        if labels is not None:
+            labels = labels.new_full([bs, new_len + 1], -100).scatter(1, idx, labels)
+            labels = labels[:, :new_len]
+
+        return hidden_states, masks, labels
+
+    def encode_mt(self, input_ids_mt, attention_mask_mt):
+        use_cache = self.encoder_cache_bytes > 0 and not self.training
+        if use_cache:
+            key = (tuple(input_ids_mt.size()),
+                   input_ids_mt.cpu().numpy().tobytes(),
+                   attention_mask_mt.cpu().numpy().tobytes())
+            if key in self.encoder_cache:
+                self.encoder_cache.move_to_end(key)
+                return self.encoder_cache[key].to(input_ids_mt.device, non_blocking=True)
+        # the MT encoder is frozen, nothing has to be recorded for backward
+        with torch.no_grad():
+            mt_encoder_outputs = self.encoder_mt(input_ids=input_ids_mt,
+                                                 attention_mask=attention_mask_mt,
+                                                 output_hidden_states=False,
+                                                 return_dict=True)
+        encoder_last_hidden_state = mt_encoder_outputs.last_hidden_state
+        if use_cache:
+            cached = encoder_last_hidden_state.cpu()
+            self.encoder_cache[key] = cached
+            self.encoder_cache_used += cached.numel() * cached.element_size()
+            while self.encoder_cache_used > self.encoder_cache_bytes:
+                _, evicted = self.encoder_cache.popitem(last=False)
+                self.encoder_cache_used -= evicted.numel() * evicted.element_size()
+        return encoder_last_hidden_state
 
     def forward(self, input_ids_mt, attention_mask_mt,
                 labels=None, mask_label=None, input_ids_prompt=None, mask_prompt=None):
@@ -92,49 +151,54 @@ class MindMerger(nn.Module):
         bs = input_ids_mt.size(0)
         end_boundary = end_boundary.expand([bs, 1, end_boundary.size(-1)])
 
-        bos = torch.tensor([self.llm_bos_token_id for i in range(bs)], dtype=torch.long).cuda()
-        bos_embedding = self.llm_embedding_layer(bos)
-        bos_embedding = bos_embedding.view(bs, 1, -1)
-        mask = torch.ones([bs, 1], dtype=torch.long).cuda()
-        llm_input_embedding = bos_embedding
-        llm_input_mask = mask
-
-        mt_encoder_outputs = self.encoder_mt(input_ids=input_ids_mt,
-                                             attention_mask=attention_mask_mt,
-                                             output_hidden_states=True)
-        encoder_last_hidden_state = mt_encoder_outputs[0]
+        bos_embedding = self.bos_embedding.expand([bs, 1, self.bos_embedding.size(-1)])
+        mask = self.ones_mask.expand(bs, 1)
+
+        encoder_last_hidden_state = self.encode_mt(input_ids_mt, attention_mask_mt)
+        # the MT encoder runs in bf16; feed the mapping layer in whatever dtype it was loaded in
+        encoder_last_hidden_state = encoder_last_hidden_state.to(self.mapping.mlp.linear1.weight.dtype)
         mt_hidden_state = self.mapping(encoder_last_hidden_state)
-        llm_input_embedding = torch.cat([llm_input_embedding, mt_hidden_state, end_boundary],
-                                        dim=1)
-        llm_input_mask = torch.cat([llm_input_mask, attention_mask_mt, mask], dim=1)
+        segments = [(bos_embedding, mask), (mt_hidden_state, attention_mask_mt), (end_boundary, mask)]
 
         if input_ids_prompt is not None:
-
             hidden_states_prompt = self.llm_embedding_layer(input_ids_prompt)
-            llm_input_embedding = torch.cat([llm_input_embedding, hidden_states_prompt], dim=1)
-            llm_input_mask = torch.cat([llm_input_mask, mask_prompt], dim=1)
+            segments.append((hidden_states_prompt, mask_prompt))
         if labels is not None:
-            pad_labels = llm_input_mask * -100 + (1 - llm_input_mask) * -100
             label_embedding = self.llm_embedding_layer(labels)
-            llm_input_embedding = torch.cat([llm_input_embedding, label_embedding], dim=1)
-            llm_input_mask = torch.cat([llm_input_mask, mask_label], dim=1)
+            segments.append((label_embedding, mask_label))
+
+        # write the segments into one buffer instead of growing it with repeated torch.cat
+        total_len = sum(segment_mask.size(1) for _, segment_mask in segments)
+        llm_input_embedding = bos_embedding.new_empty([bs, total_len, bos_embedding.size(-1)])
+        llm_input_mask = attention_mask_mt.new_empty([bs, total_len])
+        start = 0
+        for segment_embedding, segment_mask in segments:
+            end = start + segment_mask.size(1)
+            llm_input_embedding[:, start:end] = segment_embedding
+            llm_input_mask[:, start:end] = segment_mask
+            start = end
+
+        if labels is not None:
+            label_len = labels.size(1)
             labels = labels * mask_label - 100 * (1 - mask_label)
-            labels = torch.cat([pad_labels, labels], dim=1)
+            pad_labels = labels.new_full([bs, total_len], -100)
+            pad_labels[:, -label_len:] = labels
+            labels = pad_labels
 
-        llm_input_embedding, llm_input_mask, cut_pad_idx \
-            = self.squeeze_pad(llm_input_embedding, llm_input_mask)
+        llm_input_embedding, llm_input_mask, labels \
+            = self.squeeze_pad(llm_input_embedding, llm_input_mask, labels)
 
         if labels is None:
-            generate_ids = self.model_llm.generate(inputs_embeds=llm_input_embedding,
-                                                   attention_mask=llm_input_mask,
-                                                   max_new_tokens=self.max_gen_len,
-                                                   pad_token_id=self.llm_pad_token_id,
-                                                   do_sample=False)
+            with torch.inference_mode():
+                generate_ids = self.model_llm.generate(inputs_embeds=llm_input_embedding,
+                                                       attention_mask=llm_input_mask,
+                                                       max_new_tokens=self.max_gen_len,
+                                                       pad_token_id=self.llm_pad_token_id,
+                                                       do_sample=False,
+                                                       num_beams=1,
+                                                       use_cache=True)
             return generate_ids
         else:
-            bs, seq_len = labels.size()
-            labels = labels[cut_pad_idx]
-            labels = labels.view(bs, -1)
             output = self.model_llm(inputs_embeds=llm_input_embedding,
                                     attention_mask=llm_input_mask,
                                     labels=labels)
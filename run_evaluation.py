@@ -1,21 +1,26 @@
 import torch.fx
+import torch._dynamo
+import torch._inductor.config
 from transformers import AutoTokenizer
 import torch
 from mindmerger_tools.read_datasets import *
 from mindmerger_tools.utils import save_model, set_seed, extract_last_num
 import argparse
 import ast
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Subset
 import json
 from modeling_mindmerger import MindMerger
 import os
 from evaluation import *
 import deepspeed
 from mindmerger_tools.deepspeed_config import get_train_ds_config
+from mindmerger_tools.input_features import collate_features, get_langs_map
+from functools import partial
 
 def main(args):
     llm_path = args.llm_path
     mt_path = args.mt_path
+    langs_map = get_langs_map(mt_path)
 
     max_seq_len = args.max_seq_len
     max_gen_len = args.max_gen_len
@@ -27,6 +32,12 @@ def main(args):
     task = args.task
 
     result_path_base = f'./results/{save_name}/{task}/'
+    if args.use_compile:
+        # keep inductor's compiled graphs on disk so reruns of the same model skip codegen;
+        # cuda graphs from mode='reduce-overhead' are still recorded at the start of every run
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', f'./.inductor_cache/{save_name}')
+        torch._inductor.config.fx_graph_cache = True
+        torch._dynamo.config.cache_size_limit = 64
 
     if 'mgsm' in task:
         test_sets = read_mgsms()
@@ -40,7 +51,7 @@ def main(args):
         test_sets = read_xnli()
 
     os.makedirs(result_path_base, exist_ok=True)
-    tokenizer_m2m = AutoTokenizer.from_pretrained(mt_path)
+    tokenizer_m2m = AutoTokenizer.from_pretrained(mt_path, use_fast=True)
     tokenizer_llm = AutoTokenizer.from_pretrained(llm_path, use_fast=True)
     tokenizer_llm.pad_token = tokenizer_llm.eos_token
     tokenizer_llm.padding_side = "left"
@@ -54,54 +65,85 @@ def main(args):
         'result_path_base': result_path_base
     }, indent=2))
 
-    train_micro_batch_size_per_gpu = args.train_micro_batch_size_per_gpu
-    train_batch_size = args.train_batch_size
-    gpu_num = torch.cuda.device_count()
-    gradient_accumulation = train_batch_size // (train_micro_batch_size_per_gpu * gpu_num)
-    assert train_micro_batch_size_per_gpu * gpu_num * gradient_accumulation == train_batch_size
-    ds_config = get_train_ds_config(train_batch_size=train_batch_size,
-                                    train_micro_batch_size_per_gpu=train_micro_batch_size_per_gpu,
-                                    gradient_accumulation_steps=gradient_accumulation,
-                                    )
-
-
     model = MindMerger(mt_path, llm_path, max_gen_len,
                        tokenizer_llm.bos_token_id,
-                       tokenizer_llm.pad_token_id)
+                       tokenizer_llm.pad_token_id,
+                       use_compile=args.use_compile,
+                       llm_quantization=args.llm_quantization)
 
 
     if args.init_checkpoint is not None:
         init_checkpoint = args.init_checkpoint
-        checkpoint = torch.load(init_checkpoint, map_location='cpu')
+        # mapping checkpoints are plain tensor dicts; they use the legacy format, so mmap is not available
+        checkpoint = torch.load(init_checkpoint, map_location='cpu', weights_only=True)
         model_dict = checkpoint['model_state_dict']
         model.mapping.load_state_dict(model_dict, True)
+        del checkpoint, model_dict
         print('mapping init from:', init_checkpoint)
-    # model = model.cuda()
-    parameters = filter(lambda p: p.requires_grad, model.parameters())
-    model, optimizer, _, __ = deepspeed.initialize(
-        config=ds_config,
-        model=model,
-        model_parameters=parameters,
-        training_data=None)
+    # --deepspeed is registered by deepspeed.add_config_arguments
+    if args.deepspeed:
+        train_micro_batch_size_per_gpu = args.train_micro_batch_size_per_gpu
+        train_batch_size = args.train_batch_size
+        gpu_num = torch.cuda.device_count()
+        gradient_accumulation = train_batch_size // (train_micro_batch_size_per_gpu * gpu_num)
+        assert train_micro_batch_size_per_gpu * gpu_num * gradient_accumulation == train_batch_size
+        ds_config = get_train_ds_config(train_batch_size=train_batch_size,
+                                        train_micro_batch_size_per_gpu=train_micro_batch_size_per_gpu,
+                                        gradient_accumulation_steps=gradient_accumulation,
+                                        )
+        parameters = filter(lambda p: p.requires_grad, model.parameters())
+        model, optimizer, _, __ = deepspeed.initialize(
+            config=ds_config,
+            model=model,
+            model_parameters=parameters,
+            training_data=None)
+    else:
+        # evaluation does no training, the deepspeed engine would only add hooks around every forward
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+        model = model.to(device='cuda', dtype=torch.bfloat16)
     scores_map = {}
     avg = 0
+    collate_fn = partial(collate_features, tokenizer_m2m=tokenizer_m2m, tokenizer_llm=tokenizer_llm,
+                         max_seq_len=max_seq_len, max_gen_len=max_gen_len, langs_map=langs_map,
+                         use_prompt=augmentation, pad_to_multiple_of=64 if args.use_compile else None)
+    # evaluate all languages in one pass so that batches stay full across language boundaries,
+    # results are split back per language afterwards
+    test_data, lang_spans = [], {}
+    for test_lang in test_sets:
+        lang_spans[test_lang] = (len(test_data), len(test_data) + len(test_sets[test_lang]))
+        test_data += test_sets[test_lang]
+    test_set = MathDataset(test_data, task)
+    # batch sources of similar MT length together to cut padding, results are put back in order below
+    sources = [test_set[i]['source'] for i in range(len(test_set))]
+    lengths = [len(input_ids) for input_ids in
+               tokenizer_m2m(sources, max_length=max_seq_len, truncation=True).input_ids]
+    order = sorted(range(len(test_set)), key=lambda i: lengths[i])
+    test_set = Subset(test_set, order)
+    test_sampler = SequentialSampler(test_set)
+    loader_kwargs = dict(num_workers=args.num_workers, pin_memory=True, collate_fn=collate_fn)
+    if args.num_workers > 0:
+        loader_kwargs.update(prefetch_factor=args.prefetch_factor)
+    test_set = torch.utils.data.DataLoader(
+        dataset=test_set,
+        batch_size=eval_batch_size,
+        sampler=test_sampler,
+        shuffle=False,
+        drop_last=False,
+        **loader_kwargs)
+    if 'math' in task:
+        _, sorted_results_list, sorted_hits = evaluate_math(model, test_set, tokenizer_llm)
+    else:
+        _, sorted_results_list, sorted_hits = evaluate_classification(model, test_set, tokenizer_llm)
+    all_results_list, all_hits = [None] * len(order), [None] * len(order)
+    for result, result_hit, i in zip(sorted_results_list, sorted_hits, order):
+        all_results_list[i] = result
+        all_hits[i] = result_hit
     for test_lang in test_sets:
-        test_set = test_sets[test_lang]
-        test_sampler = SequentialSampler(test_set)
-        test_set = MathDataset(test_set, task)
-        test_set = torch.utils.data.DataLoader(
-            dataset=test_set,
-            batch_size=eval_batch_size,
-            sampler=test_sampler,
-            shuffle=False,
-            num_workers=1,
-            drop_last=False)
-        if 'math' in task:
-            acc, results_list = evaluate_math(model, test_set, tokenizer_llm, tokenizer_m2m,
-                                                     max_seq_len, max_gen_len, augmentation, langs_map)
-        else:
-            acc, results_list = evaluate_classification(model, test_set, tokenizer_llm, tokenizer_m2m,
-                                              max_seq_len, max_gen_len, augmentation, langs_map)
+        start, end = lang_spans[test_lang]
+        results_list = all_results_list[start:end]
+        # the evaluation functions score every sample, all languages share one pass
+        hit = sum(all_hits[start:end])
+        acc = round(hit / len(results_list) * 100, 2)
         print('test_lang:', test_lang, 'acc:', acc)
         scores_map[test_lang] = acc
         result_path = f'{result_path_base}/{test_lang}.json'
@@ -185,30 +227,37 @@ if __name__ == "__main__":
         type=int,
         default=1
     )
+    parser.add_argument(
+        "--use_compile",
+        type=ast.literal_eval,
+        default=False
+    )
+    parser.add_argument(
+        "--llm_quantization",
+        type=str,
+        choices=['4bit', '8bit'],
+        default=None
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=4
+    )
     parser = deepspeed.add_config_arguments(parser)
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    # generate produces highly variable allocation sizes; let the allocator grow segments instead of fragmenting
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
     set_seed(0)
 
     langs = ['Thai', 'Swahili', 'Bengali', 'Chinese', 'German', 'Spanish', 'French', 'Japanese', 'Russian', 'English']
     langs_map_flores = {'Swahili': 'swh', 'Bengali': 'ben', 'English': 'eng', 'Thai': 'tha', 'Chinese': 'zho_simpl',
                         'German': 'deu', 'Spanish': 'spa', 'French': 'fra', 'Japanese': 'jpn', 'Russian': 'rus', }
-    langs_map_m2m = {'English': 'en', 'Swahili': 'sw', 'Chinese': 'zh', 'Bengali': 'bn',
-                     'German': 'de', 'Spanish': 'es', 'French': 'fr', 'Japanese': 'ja',
-                     'Russian': 'ru', 'Thai': 'th', 'Greek': 'el', 'Telugu': 'te',
-                     'Arabic': 'ar', 'Bulgarian': 'bg', 'Croatian': 'hr', 'Hungarian': 'hu',
-                     'Italian': 'it', 'Lithuanian': 'lt', 'Macedonian': 'mk', 'Polish': 'pl',
-                     'Portuguese': 'pt', 'Albanian': 'sq', 'Serbian': 'sr', 'Turkish': 'tr',
-                     'Vietnamese': 'vi', 'Hindi': 'hi', 'Flemish': 'nl', 'Urdu': 'ur'}
-    langs_map_nllb = {
-        'English': 'eng_Latn', 'Swahili': 'swh_Latn', 'Chinese': 'zho_Hans', 'Bengali': 'ben_Beng',
-        'German': 'deu_Latn', 'Spanish': 'spa_Latn', 'French': 'fra_Latn', 'Japanese': 'jpn_Jpan',
-        'Russian': 'rus_Cyrl', 'Thai': 'tha_Thai'
-    }
-    if 'nllb' in args.mt_path:
-        langs_map = langs_map_nllb
-    else:
-        langs_map = langs_map_m2m
     main(args)
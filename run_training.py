@@ -7,8 +7,7 @@ from mindmerger_tools.utils import save_model, set_seed
 from mindmerger_tools.read_datasets import *
 import argparse
 import ast
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
-from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Subset
 import json
 import deepspeed
 from mindmerger_tools.input_features import *
@@ -16,11 +15,13 @@ from modeling_mindmerger import MindMerger
 import os
 from mindmerger_tools.deepspeed_config import get_train_ds_config
 from evaluation import evaluate_ppl
+from functools import partial
 
 
 def main(args):
     llm_path = args.llm_path
     mt_path = args.mt_path
+    langs_map = get_langs_map(mt_path)
 
     train_num = args.train_num
     stage_name = args.stage_name
@@ -54,8 +55,9 @@ def main(args):
         else:
             train_set = read_xnli_train()
 
-    dev_set = train_set[:args.dev_size]
-    train_set = train_set[args.dev_size:]
+    # index views over the read samples instead of copying the lists
+    dev_set = Subset(train_set, range(args.dev_size))
+    train_set = Subset(train_set, range(args.dev_size, len(train_set)))
 
     train_set = MathDataset(train_set, task)
     dev_set = MathDataset(dev_set, task)
@@ -71,15 +73,18 @@ def main(args):
     gpu_num = torch.cuda.device_count()
     gradient_accumulation = train_batch_size // (train_micro_batch_size_per_gpu * gpu_num)
     assert train_micro_batch_size_per_gpu * gpu_num * gradient_accumulation == train_batch_size
-    ds_config = get_train_ds_config(train_batch_size, train_micro_batch_size_per_gpu, lr, gradient_accumulation)
+    ds_config = get_train_ds_config(train_batch_size, train_micro_batch_size_per_gpu, lr, gradient_accumulation,
+                                    bf16_enabled=True)
 
-    os.makedirs(output_model_path_base, exist_ok=True)
-    os.makedirs(result_path_base, exist_ok=True)
-    tokenizer_m2m = AutoTokenizer.from_pretrained(mt_path)
+    tokenizer_m2m = AutoTokenizer.from_pretrained(mt_path, use_fast=True)
     tokenizer_llm = AutoTokenizer.from_pretrained(llm_path, use_fast=True)
     tokenizer_llm.pad_token = tokenizer_llm.eos_token
     tokenizer_llm.padding_side = "left"
     # tokenizer_llm.pad_token = "[PAD]"
+    train_set = pretokenize_features(train_set, tokenizer_m2m, tokenizer_llm, max_seq_len, max_gen_len,
+                                     langs_map, augmentation)
+    dev_set = pretokenize_features(dev_set, tokenizer_m2m, tokenizer_llm, max_seq_len, max_gen_len,
+                                   langs_map, augmentation)
 
     print(json.dumps({
         'llm_path': llm_path,
@@ -100,12 +105,17 @@ def main(args):
         args.init_checkpoint = f'./outputs/{save_name}/{task}/mapping/pytorch_model.bin'
     model = MindMerger(mt_path, llm_path, max_gen_len,
                        tokenizer_llm.bos_token_id,
-                       tokenizer_llm.pad_token_id)
+                       tokenizer_llm.pad_token_id,
+                       use_compile=args.use_compile,
+                       encoder_cache_mb=args.encoder_cache_mb,
+                       llm_quantization=args.llm_quantization)
     if args.init_checkpoint is not None:
         init_checkpoint = args.init_checkpoint
-        checkpoint = torch.load(init_checkpoint, map_location='cpu')
+        # mapping checkpoints are plain tensor dicts; they use the legacy format, so mmap is not available
+        checkpoint = torch.load(init_checkpoint, map_location='cpu', weights_only=True)
         model_dict = checkpoint['model_state_dict']
         model.mapping.load_state_dict(model_dict, False)
+        del checkpoint, model_dict
         print('mapping layer init from:', init_checkpoint)
 
     parameters = filter(lambda p: p.requires_grad, model.parameters())
@@ -114,86 +124,95 @@ def main(args):
         model=model,
         model_parameters=parameters,
         training_data=None)
-
-    train_sampler = DistributedSampler(train_set)
+    global_rank = torch.distributed.get_rank()
+    if global_rank == 0 and train_micro_batch_size_per_gpu == 1:
+        # per-step overhead dominates single-sample micro batches; length grouping keeps larger ones cheap
+        print('warning: train_micro_batch_size_per_gpu is 1, a larger micro batch (e.g. 4-8) uses the GPU far better')
+    # one rank creates the output directories, the others wait instead of racing on the filesystem
+    if global_rank == 0:
+        os.makedirs(output_model_path_base, exist_ok=True)
+        os.makedirs(result_path_base, exist_ok=True)
+    torch.distributed.barrier()
+    if args.gradient_checkpointing:
+        # the LLM is frozen but still keeps its activations for the backward pass into the mapping
+        model.module.model_llm.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
+
+    # group by every padded sequence of a sample: MT input, prompt (augmentation stage) and labels
+    train_sampler = LengthGroupedDistributedSampler(train_set,
+                                                    [len(sample['input_ids_mt']) + len(sample['labels'])
+                                                     + len(sample.get('input_ids_prompt', ()))
+                                                     for sample in train_set],
+                                                    train_micro_batch_size_per_gpu)
     dev_sampler = SequentialSampler(dev_set)
 
+    # the sets are tokenized once above, workers only pad the next batches while the current step runs
+    collate_fn = partial(collate_pretokenized, mt_pad_token_id=tokenizer_m2m.pad_token_id,
+                         llm_pad_token_id=tokenizer_llm.pad_token_id,
+                         pad_to_multiple_of=64 if args.use_compile else None)
+    loader_kwargs = dict(num_workers=args.num_workers, pin_memory=True, collate_fn=collate_fn)
+    if args.num_workers > 0:
+        loader_kwargs.update(prefetch_factor=args.prefetch_factor, persistent_workers=True)
     train_set = torch.utils.data.DataLoader(
         dataset=train_set,
         batch_size=train_micro_batch_size_per_gpu,
         sampler=train_sampler,
+        **loader_kwargs
     )
     dev_set = torch.utils.data.DataLoader(
         dataset=dev_set,
         batch_size=eval_batch_size,
         shuffle=False,
         sampler=dev_sampler,
-        num_workers=1,
-        drop_last=False)
+        drop_last=False,
+        **loader_kwargs)
 
-    global_rank = torch.distributed.get_rank()
     # best_perplexity = 1000000000
-    best_perplexity = evaluate_ppl(model, dev_set, tokenizer_llm, tokenizer_m2m,
-                                   max_seq_len, max_gen_len, langs_map, augmentation)
+    best_perplexity = evaluate_ppl(model, dev_set)
     eval_step = 2000
     for epoch in range(epoch_num):
+        train_sampler.set_epoch(epoch)
         model.train()
-        tr_loss, nb_tr_steps = 0, 0
+        # accumulated on the GPU, only read back when the progress bar is refreshed
+        tr_loss, nb_tr_steps = torch.zeros([], device=model.device), 0
         step_count = 0
         step_trange = tqdm(train_set)
         for train_step in step_trange:
-            sources = train_step['source']
-            prompts = train_step['prompt']
-            targets = train_step['target']
-            source_languages = train_step['source_language']
-
-            input_ids_m2m, attention_mask_m2m = mt_input_features(sources, tokenizer_m2m,
-                                                                  max_seq_len, source_languages,
-                                                                  langs_map)
-            add_bos_token = False
-            add_eos_token = True
-            labels, mask_label = llm_input_features(targets, tokenizer_llm,
-                                                    max_gen_len, add_bos_token, add_eos_token)
-
-            input_ids_prompt, mask_prompt = None, None
-            if augmentation:
-                add_bos_token = False
-                add_eos_token = False
-                input_ids_prompt, mask_prompt = llm_input_features(prompts, tokenizer_llm,
-                                                                   max_gen_len, add_bos_token,
-                                                                   add_eos_token)
-
-            loss = model(input_ids_m2m, attention_mask_m2m,
-                         input_ids_prompt=input_ids_prompt, mask_prompt=mask_prompt,
-                         labels=labels, mask_label=mask_label)
-            loss = loss.mean()
-            tr_loss += loss.item()
+            train_step = features_to_cuda(train_step)
+            loss = model(train_step['input_ids_mt'], train_step['attention_mask_mt'],
+                         input_ids_prompt=train_step['input_ids_prompt'], mask_prompt=train_step['mask_prompt'],
+                         labels=train_step['labels'], mask_label=train_step['mask_label'])
             nb_tr_steps += 1
             model.backward(loss)
             model.step()
+            tr_loss += loss.detach().float()
 
-            loss_show = ' Epoch:' + str(epoch) + " loss:" + str(round(tr_loss / nb_tr_steps, 4)) #+ f" lr:{'%.2E' % scheduler.get_last_lr()[0]}"
-            step_trange.set_postfix_str(loss_show)
+            if nb_tr_steps % 100 == 0:
+                loss_show = ' Epoch:' + str(epoch) + " loss:" + str(round(tr_loss.item() / nb_tr_steps, 4)) #+ f" lr:{'%.2E' % scheduler.get_last_lr()[0]}"
+                step_trange.set_postfix_str(loss_show)
 
             if step_count % eval_step == 0 and step_count > 0:
-                perplexity = evaluate_ppl(model, dev_set, tokenizer_llm, tokenizer_m2m,
-                                          max_seq_len, max_gen_len, langs_map, augmentation)
+                perplexity = evaluate_ppl(model, dev_set, cutoff=best_perplexity)
                 print('ppl:', perplexity)
-                if global_rank == 0 and perplexity < best_perplexity:
+                # every rank scores the full dev set, so all of them track the same best value and
+                # pass the same cutoff to the next evaluation
+                if perplexity < best_perplexity:
                     best_perplexity = perplexity
-                    save_model(output_model_path_base, model.mapping)
-                    print('save new best')
+                    if global_rank == 0:
+                        save_model(output_model_path_base, model.mapping)
+                        print('save new best')
             step_count += 1
 
 
 
-        perplexity = evaluate_ppl(model, dev_set, tokenizer_llm, tokenizer_m2m,
-                                  max_seq_len, max_gen_len, langs_map, augmentation)
+        perplexity = evaluate_ppl(model, dev_set, cutoff=best_perplexity)
         print('ppl:', perplexity)
-        if global_rank == 0 and perplexity < best_perplexity:
+        # every rank scores the full dev set, so all of them track the same best value and
+        # pass the same cutoff to the next evaluation
+        if perplexity < best_perplexity:
             best_perplexity = perplexity
-            save_model(output_model_path_base, model.mapping)
-            print('save new best')
+            if global_rank == 0:
+                save_model(output_model_path_base, model.mapping)
+                print('save new best')
 
 
 if __name__ == "__main__":
@@ -288,6 +307,37 @@ if __name__ == "__main__":
         type=ast.literal_eval,
         default=False
     )
+    parser.add_argument(
+        "--use_compile",
+        type=ast.literal_eval,
+        default=False
+    )
+    parser.add_argument(
+        "--encoder_cache_mb",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--llm_quantization",
+        type=str,
+        choices=['4bit', '8bit'],
+        default=None
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        type=ast.literal_eval,
+        default=False
+    )
     parser = deepspeed.add_config_arguments(parser)
     args = parser.parse_args()
 
@@ -299,22 +349,4 @@ if __name__ == "__main__":
     langs_map_flores = {'Swahili': 'swh', 'Benli': 'ben', 'English': 'eng', 'Thai': 'tha', 'Chinese': 'zho_simpl',
                         'German': 'deu', 'Spanish': 'spa', 'French': 'fra', 'Japanese': 'jpn', 'Russian': 'rus', }
 
-    langs_map_m2m = {'English': 'en', 'Swahili': 'sw', 'Chinese': 'zh', 'Bengali': 'bn',
-     'German': 'de', 'Spanish': 'es', 'French': 'fr', 'Japanese': 'ja',
-     'Russian': 'ru', 'Thai': 'th', 'Greek': 'el', 'Telugu': 'te',
-     'Arabic': 'ar', 'Bulgarian': 'bg', 'Croatian': 'hr', 'Hungarian': 'hu',
-     'Italian': 'it', 'Lithuanian': 'lt', 'Macedonian': 'mk', 'Polish': 'pl',
-     'Portuguese': 'pt', 'Albanian': 'sq', 'Serbian': 'sr', 'Turkish': 'tr',
-     'Vietnamese': 'vi', 'Hindi': 'hi', 'Flemish': 'nl', 'Urdu': 'ur'}
-
-    langs_map_nllb = {
-        'English': 'eng_Latn', 'Swahili': 'swh_Latn', 'Chinese': 'zho_Hans', 'Bengali': 'ben_Beng',
-        'German': 'deu_Latn', 'Spanish': 'spa_Latn', 'French': 'fra_Latn', 'Japanese': 'jpn_Jpan',
-        'Russian': 'rus_Cyrl', 'Thai': 'tha_Thai'
-    }
-
-    if 'nllb' in args.mt_path:
-        langs_map = langs_map_nllb
-    else:
-        langs_map = langs_map_m2m
     main(args)